@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import argparse
+from collections import Counter
+
+import polars as pl
+
+# Raporun özet tabloları; her biri listelenen sütunların her birleşimi için kayıtları sayar.
+# "year" release_date'ten türetilir, diğer tüm adlar discogs.csv'nin sütunlarıdır.
+aggregates = {
+    "releases_per_year": ["year"],
+    "releases_per_country": ["country"],
+    "releases_per_genre": ["genre"],
+    "releases_per_style": ["style"],
+    "releases_per_format": ["format"],
+    "releases_per_label": ["label_id", "label_name"],
+    "releases_per_master": ["master_id"],
+}
+
+
+def release_year(release_date):
+    year = (release_date or "")[:4]
+    return year if len(year) == 4 and year.isdigit() else None
+
+
+def sort_summary(df, keys):
+    return df.sort(["releases", *keys], descending=[True] + [False] * len(keys), nulls_last=True)
+
+
+def scan_outputs(paths):
+    # CSV veya Parquet çıktılarını tembel olarak tara; özetler toplanana kadar hiçbir şey okunmaz
+    csv_paths = [path for path in paths if not path.endswith(".parquet")]
+    parquet_paths = [path for path in paths if path.endswith(".parquet")]
+    scans = []
+    if csv_paths:
+        scans.append(pl.scan_csv(csv_paths, infer_schema=False))
+    if parquet_paths:
+        # CSV taramasında olduğu gibi String'e dönüştür, böylece CSV ve Parquet girdileri birleştirilebilir
+        scans.append(pl.scan_parquet(parquet_paths).select(pl.all().cast(pl.String)))
+    return pl.concat(scans, how="diagonal") if len(scans) > 1 else scans[0]
+
+
+def aggregate_query(scan, keys):
+    columns = []
+    for key in keys:
+        if key == "year":
+            year = pl.col("release_date").cast(pl.String).str.slice(0, 4)
+            columns.append(pl.when(year.str.contains(r"^\d{4}$")).then(year).alias("year"))
+        else:
+            columns.append(pl.col(key).cast(pl.String))
+    # Yalnızca gruplanan sütunları seçmek, taramanın notes dahil diğer tüm sütunları atlamasını sağlar
+    return scan.select(columns).group_by(keys).agg(pl.len().cast(pl.Int64).alias("releases"))
+
+
+def compute_report(paths, names):
+    scan = scan_outputs(paths)
+    queries = [aggregate_query(scan, aggregates[name]) for name in names]
+    # Tüm özetler akış motoruyla hesaplanır, böylece çıktıların belleğe sığması gerekmez
+    results = pl.collect_all(queries, engine="streaming")
+    return {name: sort_summary(df, aggregates[name]) for name, df in zip(names, results)}
+
+
+def write_report(summaries, output_dir, output_format):
+    os.makedirs(output_dir, exist_ok=True)
+    for name, df in summaries.items():
+        output_path = os.path.join(output_dir, f"{name}.{output_format}")
+        if output_format == "parquet":
+            df.write_parquet(output_path)
+        else:
+            df.write_csv(output_path)
+        print(f"{output_path}: {df.height} satır")
+
+
+class AggregateAccumulator:
+    # Satırlar üretilirken aynı özetleri güncel tutar, böylece ikinci bir geçiş gerekmez
+
+    def __init__(self, names=None):
+        self.counters = {name: Counter() for name in (names or aggregates)}
+
+    def add_rows(self, rows):
+        for row in rows:
+            values = dict(row, year=release_year(row["release_date"]))
+            for name, counter in self.counters.items():
+                counter[tuple(values[key] for key in aggregates[name])] += 1
+
+    def update(self, other):
+        for name, counter in other.counters.items():
+            self.counters.setdefault(name, Counter()).update(counter)
+
+    def save(self, path):
+        data = {name: [[*key, count] for key, count in counter.items()] for name, counter in self.counters.items()}
+        with open(path, "w", encoding="utf-8") as json_file:
+            json.dump(data, json_file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as json_file:
+            data = json.load(json_file)
+        accumulator = cls(list(data))
+        for name, entries in data.items():
+            accumulator.counters[name].update({tuple(entry[:-1]): entry[-1] for entry in entries})
+        return accumulator
+
+    def summaries(self):
+        summaries = {}
+        for name, counter in self.counters.items():
+            keys = aggregates[name]
+            schema = {key: pl.String for key in keys} | {"releases": pl.Int64}
+            df = pl.DataFrame([[*key, count] for key, count in counter.items()], schema=schema, orient="row")
+            summaries[name] = sort_summary(df, keys)
+        return summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Discogs çıktılarını belleğe yüklemeden özetle.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report_command = commands.add_parser("report", help="CSV veya Parquet çıktılarından özet tabloları hesapla")
+    report_command.add_argument("inputs", nargs="+", help="discogs.csv, CSV parçaları veya Parquet dosyaları")
+    report_command.add_argument("--output", default="reports", help="Özet tabloların klasörü")
+    report_command.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    report_command.add_argument("--aggregates", default=",".join(aggregates),
+                                help=f"Virgülle ayrılmış alt küme: {', '.join(aggregates)}")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.aggregates.split(",") if name.strip()]
+    unknown = [name for name in names if name not in aggregates]
+    if unknown:
+        parser.error(f"bilinmeyen özetler: {', '.join(unknown)}")
+
+    start_time = time.time()
+    write_report(compute_report(args.inputs, names), args.output, args.format)
+    print(f"Geçen Süre: {time.time() - start_time:.1f} saniye")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import os
+import re
+import csv
+import sys
+import time
+import heapq
+import shutil
+import bisect
+from array import array
+from collections import defaultdict
+
+# Files of an index folder:
+#   postings.bin    sorted release ids of every term, stored as unsigned 32 bit integers
+#   lexicon.tsv     term, offset into postings.bin and number of releases, sorted by term
+#   lexicon.sparse  every sparse_every-th term of lexicon.tsv with its byte offset, loaded into memory
+searched_columns = ["title", "artist_name", "notes"]
+sparse_every = 128
+postings_per_run = 10_000_000  # Postings kept in memory before a sorted run is written to disk
+postings_per_write = 65_536  # Release ids buffered before they are appended to postings.bin
+token_pattern = re.compile(r"\w+")
+max_release_id = 2 ** 32 - 1  # Largest release id a posting can hold
+
+
+def tokenize(text):
+    return [token for token in token_pattern.findall(text.lower()) if len(token) <= 64]
+
+
+def read_run(run_path):
+    # Yield (term, release ids) from a sorted run file
+    with open(run_path, "r", encoding="utf-8") as run_file:
+        for line in run_file:
+            term, release_ids = line.rstrip("\n").split("\t")
+            yield term, array("I", map(int, release_ids.split(",")))
+
+
+def release_terms(rows):
+    # Yield (release id, distinct terms) of every row.
+    # Ids mangled in recover mode cannot be stored as postings; skip them so indexing never stops the ingestion
+    for row in rows:
+        release_id = row["release_id"]
+        if release_id and release_id.isdecimal() and int(release_id) <= max_release_id:
+            terms = set()
+            for column in searched_columns:
+                if row[column]:
+                    terms.update(tokenize(row[column]))
+            yield int(release_id), terms
+
+
+def write_sorted_run(postings, run_path):
+    # Write term -> release ids as a run sorted by term, the input of merge_runs
+    with open(run_path, "w", encoding="utf-8") as run_file:
+        for term in sorted(postings):
+            release_ids = sorted(postings[term])
+            run_file.write(f"{term}\t{','.join(map(str, release_ids))}\n")
+
+
+def write_rows_run(rows, run_path):
+    # One sorted run for rows already held in memory, e.g. the rows of a distributed work unit
+    postings = defaultdict(lambda: array("I"))
+    for release_id, terms in release_terms(rows):
+        for term in terms:
+            postings[term].append(release_id)
+    write_sorted_run(postings, run_path)
+
+
+def merge_runs(run_paths, index_dir):
+    # K-way merge of sorted runs into postings.bin, lexicon.tsv and lexicon.sparse of index_dir
+    os.makedirs(index_dir, exist_ok=True)
+    postings_offset = 0
+    term_count = 0
+    with open(os.path.join(index_dir, "postings.bin"), "wb") as postings_file, \
+            open(os.path.join(index_dir, "lexicon.tsv"), "wb") as lexicon_file, \
+            open(os.path.join(index_dir, "lexicon.sparse"), "w", encoding="utf-8") as sparse_file:
+        runs = [read_run(run_path) for run_path in run_paths]
+        merged = heapq.merge(*runs, key=lambda entry: entry[0])
+        current_term = None
+        current_ids = []
+
+        def write_term(term, id_lists):
+            nonlocal postings_offset, term_count
+            # Every run holds its ids sorted, so they are merged and written out without collecting them.
+            # The same release may appear more than once when rows were added twice
+            term_offset = postings_offset
+            release_count = 0
+            previous_id = None
+            buffer = array("I")
+            for release_id in heapq.merge(*id_lists):
+                if release_id == previous_id:
+                    continue
+                buffer.append(release_id)
+                previous_id = release_id
+                if len(buffer) >= postings_per_write:
+                    postings_file.write(buffer.tobytes())
+                    release_count += len(buffer)
+                    del buffer[:]
+            postings_file.write(buffer.tobytes())
+            release_count += len(buffer)
+            postings_offset += release_count * buffer.itemsize
+            if term_count % sparse_every == 0:
+                sparse_file.write(f"{term}\t{lexicon_file.tell()}\n")
+            lexicon_file.write(f"{term}\t{term_offset}\t{release_count}\n".encode("utf-8"))
+            term_count += 1
+
+        for term, release_ids in merged:
+            if term != current_term and current_term is not None:
+                write_term(current_term, current_ids)
+                current_ids = []
+            current_term = term
+            current_ids.append(release_ids)
+        if current_term is not None:
+            write_term(current_term, current_ids)
+    return term_count
+
+
+class SearchIndexBuilder:
+    # Builds the index in sorted runs so that memory use does not depend on the size of the dump
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.runs_dir = os.path.join(index_dir, "runs")
+        os.makedirs(self.runs_dir, exist_ok=True)
+        self.postings = defaultdict(lambda: array("I"))
+        self.pending = 0
+        self.run_paths = []
+
+    def add_rows(self, rows):
+        for release_id, terms in release_terms(rows):
+            for term in terms:
+                self.postings[term].append(release_id)
+            self.pending += len(terms)
+            if self.pending >= postings_per_run:
+                self.write_run()
+
+    def write_run(self):
+        if not self.postings:
+            return
+        run_path = os.path.join(self.runs_dir, f"run_{len(self.run_paths) + 1}.tsv")
+        write_sorted_run(self.postings, run_path)
+        self.run_paths.append(run_path)
+        self.postings.clear()
+        self.pending = 0
+
+    def finish(self):
+        self.write_run()
+        term_count = merge_runs(self.run_paths, self.index_dir)
+        shutil.rmtree(self.runs_dir)
+        return term_count
+
+
+class SearchIndex:
+    # Read side of the index: only the sparse lexicon is kept in memory
+
+    def __init__(self, index_dir):
+        self.lexicon_file = open(os.path.join(index_dir, "lexicon.tsv"), "rb")
+        self.postings_file = open(os.path.join(index_dir, "postings.bin"), "rb")
+        self.sparse_terms = []
+        self.sparse_offsets = []
+        with open(os.path.join(index_dir, "lexicon.sparse"), "r", encoding="utf-8") as sparse_file:
+            for line in sparse_file:
+                term, offset = line.rstrip("\n").split("\t")
+                self.sparse_terms.append(term)
+                self.sparse_offsets.append(int(offset))
+
+    def close(self):
+        self.lexicon_file.close()
+        self.postings_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def lookup(self, term):
+        # Return the sorted release ids of a single term
+        block = bisect.bisect_right(self.sparse_terms, term) - 1
+        if block < 0:
+            return array("I")
+        self.lexicon_file.seek(self.sparse_offsets[block])
+        # Terms are sorted, so the scan stops before reaching the next sparse entry
+        for line in iter(self.lexicon_file.readline, b""):
+            entry_term, offset, count = line.decode("utf-8").rstrip("\n").split("\t")
+            if entry_term == term:
+                release_ids = array("I")
+                self.postings_file.seek(int(offset))
+                release_ids.frombytes(self.postings_file.read(int(count) * release_ids.itemsize))
+                return release_ids
+            if entry_term > term:
+                break
+        return array("I")
+
+    def search(self, query, limit=None):
+        # Release ids containing every word of the query in title, artist_name or notes
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        posting_lists = sorted((self.lookup(term) for term in terms), key=len)
+        matches = set(posting_lists[0])
+        for release_ids in posting_lists[1:]:
+            if not matches:
+                break
+            matches.intersection_update(release_ids)
+        return sorted(matches)[:limit]
+
+
+def build_index_from_csv(csv_path, index_dir):
+    # Build the index from a CSV written by discogs_xml2csv, streaming it row by row
+    csv.field_size_limit(sys.maxsize)
+    builder = SearchIndexBuilder(index_dir)
+    with open(csv_path, "r", encoding="utf-8", newline="") as csv_file:
+        builder.add_rows(csv.DictReader(csv_file))
+    return builder.finish()
+
+
+def main():
+    if len(sys.argv) < 4 or sys.argv[1] not in ("build", "search"):
+        print("Usage: discogs_search_index_eng.py build <discogs.csv> <index folder>")
+        print("       discogs_search_index_eng.py search <index folder> <query> [limit]")
+        sys.exit(1)
+
+    start_time = time.time()
+    if sys.argv[1] == "build":
+        term_count = build_index_from_csv(sys.argv[2], sys.argv[3])
+        print(f"Search index with {term_count} terms created in {sys.argv[3]}")
+        print(f"Elapsed Time: {(time.time() - start_time) / 60:.0f} minutes")
+    else:
+        limit = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+        with SearchIndex(sys.argv[2]) as index:
+            start_time = time.time()
+            release_ids = index.search(sys.argv[3])
+        print(f"{len(release_ids)} releases found in {(time.time() - start_time) * 1000:.1f} ms")
+        for release_id in release_ids[:limit]:
+            print(release_id)
+
+
+if __name__ == "__main__":
+    main()
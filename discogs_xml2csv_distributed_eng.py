@@ -0,0 +1,480 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import threading
+import multiprocessing
+
+from discogs_xml2csv_eng import parse_xml_data, write_quarantine, write_rows_csv
+from discogs_report_eng import AggregateAccumulator, write_report
+from discogs_search_index_eng import merge_runs, write_rows_run
+
+# Layout of the shared folder every node must be able to reach (NFS, SMB, ...):
+#   units/   one JSON description per work unit, written by the coordinator
+#   leases/  one lease file per unit currently being processed by a worker
+#   shards/  one CSV per finished unit
+#   done/    one marker per finished unit, written after its shard is in place
+#   failed/  one marker per unit whose last attempt failed, retried until max_attempts is reached
+#   quarantine/  malformed releases of a unit, with their offset and error
+#   aggregates/  summary counts of a unit, summed up by the merge step
+#   search_runs/ sorted search index run of a unit, merged into one index by the merge step
+lease_timeout = 600  # Seconds without a heartbeat before a lease counts as expired
+max_attempts = 3  # Attempts per unit before workers give up on it
+retry_delay = 30  # Seconds to wait after a failed attempt, multiplied by the number of attempts
+release_marker = b"<release id="
+read_block_size = 1024 * 1024
+
+
+def shared_path(shared_dir, *parts):
+    return os.path.join(shared_dir, *parts)
+
+
+def prepare_shared_dir(shared_dir):
+    for folder in ("units", "leases", "shards", "done", "failed", "quarantine", "aggregates", "search_runs"):
+        os.makedirs(shared_path(shared_dir, folder), exist_ok=True)
+
+
+def write_json_atomic(path, data):
+    # Write to a private temporary file first so other nodes never see a half written file
+    temp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as json_file:
+        json.dump(data, json_file)
+    os.replace(temp_path, path)
+
+
+def read_json(path):
+    with open(path, "r", encoding="utf-8") as json_file:
+        return json.load(json_file)
+
+
+def list_unit_ids(shared_dir):
+    return sorted(file[:-5] for file in os.listdir(shared_path(shared_dir, "units")) if file.endswith(".json"))
+
+
+def is_unit_done(shared_dir, unit_id):
+    return os.path.exists(shared_path(shared_dir, "done", f"{unit_id}.json"))
+
+
+def read_failure(shared_dir, unit_id):
+    # The failure marker of a unit, or None if its last attempt did not fail
+    try:
+        return read_json(shared_path(shared_dir, "failed", f"{unit_id}.json"))
+    except FileNotFoundError:
+        return None
+
+
+def is_unit_given_up(shared_dir, unit_id):
+    failure = read_failure(shared_dir, unit_id)
+    return failure is not None and failure["attempts"] >= max_attempts
+
+
+def is_retry_due(shared_dir, unit_id):
+    failure = read_failure(shared_dir, unit_id)
+    return failure is None or time.time() - failure["failed_at"] >= retry_delay * failure["attempts"]
+
+
+def plan_chunk_units(chunk_folder):
+    # Every file produced by discogs_xmlchunker is one work unit
+    units = []
+    for file_name in sorted(os.listdir(chunk_folder)):
+        if file_name.endswith(".xml"):
+            units.append({
+                "unit_id": file_name[:-4], "kind": "file",
+                "path": os.path.abspath(os.path.join(chunk_folder, file_name))
+            })
+    return units
+
+
+def find_release_start(data_file, offset, data_end):
+    # Return the offset of the first "<release id=" at or after offset, or data_end if there is none
+    data_file.seek(offset)
+    position = offset
+    carry = b""
+    while position < data_end:
+        block = data_file.read(read_block_size)
+        if not block:
+            break
+        buffered = carry + block
+        index = buffered.find(release_marker)
+        if index != -1:
+            return min(position - len(carry) + index, data_end)
+        carry = buffered[-(len(release_marker) - 1):]
+        position += len(block)
+    return data_end
+
+
+def find_data_end(data_file):
+    # Releases end where the closing </releases> tag starts
+    file_size = os.fstat(data_file.fileno()).st_size
+    tail_start = max(file_size - read_block_size, 0)
+    data_file.seek(tail_start)
+    index = data_file.read().rfind(b"</releases>")
+    if index == -1:
+        return file_size
+    return tail_start + index
+
+
+def plan_range_units(xml_path, unit_count):
+    # Split the uncompressed dump into unit_count byte ranges aligned on <release> boundaries
+    xml_path = os.path.abspath(xml_path)
+    with open(xml_path, "rb") as data_file:
+        data_end = find_data_end(data_file)
+        starts = set()
+        for unit_number in range(unit_count):
+            starts.add(find_release_start(data_file, data_end * unit_number // unit_count, data_end))
+    starts = sorted(start for start in starts if start < data_end)
+
+    units = []
+    for unit_number, start in enumerate(starts):
+        end = starts[unit_number + 1] if unit_number + 1 < len(starts) else data_end
+        units.append({
+            "unit_id": f"range_{unit_number + 1:05d}", "kind": "range",
+            "path": xml_path, "start": start, "end": end
+        })
+    return units
+
+
+def plan(shared_dir, chunk_folder=None, xml_path=None, unit_count=None):
+    prepare_shared_dir(shared_dir)
+    if list_unit_ids(shared_dir):
+        print("Work units already planned, reusing them.")
+        return
+
+    if chunk_folder is not None:
+        units = plan_chunk_units(chunk_folder)
+    else:
+        units = plan_range_units(xml_path, unit_count)
+
+    for unit in units:
+        write_json_atomic(shared_path(shared_dir, "units", f"{unit['unit_id']}.json"), unit)
+    print(f"{len(units)} work units planned.")
+
+
+def reclaim_expired_lease(lease_path, worker_id):
+    # Returns True when the lease is gone and claiming may be attempted
+    try:
+        lease_age = time.time() - os.stat(lease_path).st_mtime
+    except FileNotFoundError:
+        return True
+    if lease_age < lease_timeout:
+        return False
+
+    # Renaming is atomic, so only one worker wins the expired lease
+    expired_path = f"{lease_path}.expired.{worker_id}"
+    try:
+        os.rename(lease_path, expired_path)
+    except FileNotFoundError:
+        return True
+
+    # Another worker may have replaced the lease between stat and rename; hand a fresh lease back
+    if time.time() - os.stat(expired_path).st_mtime < lease_timeout:
+        try:
+            os.link(expired_path, lease_path)
+        except FileExistsError:
+            pass
+        os.remove(expired_path)
+        return False
+
+    os.remove(expired_path)
+    print(f"{worker_id}: expired lease reclaimed: {os.path.basename(lease_path)}")
+    return True
+
+
+def claim_unit(shared_dir, unit_id, worker_id):
+    lease_path = shared_path(shared_dir, "leases", f"{unit_id}.lease")
+    if os.path.exists(lease_path) and not reclaim_expired_lease(lease_path, worker_id):
+        return False
+    try:
+        # O_EXCL makes creation atomic: exactly one worker gets the lease
+        lease_fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(lease_fd, "w", encoding="utf-8") as lease_file:
+        json.dump({"worker_id": worker_id, "claimed_at": time.time()}, lease_file)
+
+    # The unit may have finished between listing and claiming
+    if is_unit_done(shared_dir, unit_id):
+        os.remove(lease_path)
+        return False
+    return True
+
+
+def read_lease_owner(lease_path):
+    # The worker_id written into a lease, or None while its owner is still writing it
+    try:
+        return read_json(lease_path)["worker_id"]
+    except ValueError:
+        # A freshly created lease is empty until its owner has written it
+        return None
+
+
+def keep_lease_alive(lease_path, worker_id, stop_event):
+    # Refresh the lease modification time so other workers do not reclaim it
+    while not stop_event.wait(lease_timeout / 4):
+        try:
+            if read_lease_owner(lease_path) != worker_id:
+                # The lease expired and was reclaimed, it now belongs to another worker
+                print(f"{worker_id}: lease lost to another worker: {os.path.basename(lease_path)}")
+                return
+            os.utime(lease_path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            # Network filesystems report transient errors (ESTALE, EIO); keep the heartbeat running
+            print(f"{worker_id}: could not refresh lease {os.path.basename(lease_path)}: {str(e)}")
+
+
+def release_lease(lease_path, worker_id):
+    # Only remove the lease while it is still ours, a reclaimed lease belongs to its new owner
+    try:
+        if read_lease_owner(lease_path) == worker_id:
+            os.remove(lease_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"{worker_id}: could not release lease {os.path.basename(lease_path)}, it will expire: {str(e)}")
+
+
+def read_unit_data(unit):
+    with open(unit["path"], "rb") as data_file:
+        if unit["kind"] == "range":
+            data_file.seek(unit["start"])
+            return data_file.read(unit["end"] - unit["start"])
+        return data_file.read()
+
+
+def process_unit(shared_dir, unit_id, worker_id):
+    lease_path = shared_path(shared_dir, "leases", f"{unit_id}.lease")
+    stop_event = threading.Event()
+    heartbeat = threading.Thread(target=keep_lease_alive, args=(lease_path, worker_id, stop_event), daemon=True)
+    heartbeat.start()
+
+    start_time = time.time()
+    done_marker = {"unit_id": unit_id, "worker_id": worker_id}
+    failure_path = shared_path(shared_dir, "failed", f"{unit_id}.json")
+    try:
+        unit = read_json(shared_path(shared_dir, "units", f"{unit_id}.json"))
+        rows, quarantined = parse_xml_data(read_unit_data(unit), unit_id, unit.get("start", 0))
+        write_quarantine(quarantined, shared_path(shared_dir, "quarantine", f"{unit_id}.jsonl"))
+
+        # Aggregates and the search run go in place before the shard, so every shard the merge sees has them
+        accumulator = AggregateAccumulator()
+        accumulator.add_rows(rows)
+        aggregates_path = shared_path(shared_dir, "aggregates", f"{unit_id}.json")
+        accumulator.save(f"{aggregates_path}.{worker_id}.tmp")
+        os.replace(f"{aggregates_path}.{worker_id}.tmp", aggregates_path)
+        run_path = shared_path(shared_dir, "search_runs", f"{unit_id}.tsv")
+        write_rows_run(rows, f"{run_path}.{worker_id}.tmp")
+        os.replace(f"{run_path}.{worker_id}.tmp", run_path)
+
+        # Shards are written under a private name and moved into place, so a unit processed twice stays consistent
+        shard_path = shared_path(shared_dir, "shards", f"{unit_id}.csv")
+        temp_path = f"{shard_path}.{worker_id}.tmp"
+        write_rows_csv(rows, temp_path)
+        os.replace(temp_path, shard_path)
+        done_marker["rows"] = len(rows)
+        done_marker["quarantined"] = len(quarantined)
+        succeeded = True
+    except Exception as e:
+        print(f'Error: An error occurred while processing {unit_id}: {str(e)}')
+        failure = read_failure(shared_dir, unit_id) or {"attempts": 0}
+        failure.update(unit_id=unit_id, worker_id=worker_id, error=str(e), failed_at=time.time())
+        failure["attempts"] += 1
+        succeeded = False
+    finally:
+        stop_event.set()
+        heartbeat.join()
+
+    done_marker["elapsed_seconds"] = round(time.time() - start_time, 2)
+    if succeeded:
+        write_json_atomic(shared_path(shared_dir, "done", f"{unit_id}.json"), done_marker)
+        try:
+            os.remove(failure_path)
+        except FileNotFoundError:
+            pass
+        print(f"{worker_id}: {unit_id} finished in {done_marker['elapsed_seconds']:.0f} seconds")
+    else:
+        # No done marker: the unit stays pending and is retried by any worker after retry_delay
+        write_json_atomic(failure_path, failure)
+        print(f"{worker_id}: {unit_id} failed, attempt {failure['attempts']} of {max_attempts}")
+    release_lease(lease_path, worker_id)
+    return succeeded
+
+
+def run_worker(shared_dir, worker_id=None, poll_interval=10):
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    processed_count = 0
+
+    while True:
+        pending = [
+            unit_id for unit_id in list_unit_ids(shared_dir)
+            if not is_unit_done(shared_dir, unit_id) and not is_unit_given_up(shared_dir, unit_id)
+        ]
+        if not pending:
+            break
+
+        claimed_any = False
+        for unit_id in pending:
+            if is_retry_due(shared_dir, unit_id) and claim_unit(shared_dir, unit_id, worker_id):
+                if process_unit(shared_dir, unit_id, worker_id):
+                    processed_count += 1
+                claimed_any = True
+
+        # Remaining units are leased by other workers or waiting for a retry
+        if not claimed_any:
+            time.sleep(poll_interval)
+
+    given_up = [unit_id for unit_id in list_unit_ids(shared_dir) if is_unit_given_up(shared_dir, unit_id)]
+    print(f"{worker_id}: {processed_count} units processed, no work left.")
+    if given_up:
+        print(f"Error: {len(given_up)} work units failed {max_attempts} times and were given up, "
+              f"remove their markers from {shared_path(shared_dir, 'failed')} to retry them: {', '.join(given_up)}")
+
+
+def merge_shards(shared_dir, output_path, search_index_dir=None, report_dir=None, report_format="parquet"):
+    # Returns False without writing anything when a unit is unfinished, failed or incomplete
+    unit_ids = list_unit_ids(shared_dir)
+    given_up = [unit_id for unit_id in unit_ids if is_unit_given_up(shared_dir, unit_id)]
+    missing = [unit_id for unit_id in unit_ids if not is_unit_done(shared_dir, unit_id) and unit_id not in given_up]
+    if given_up:
+        print(f"Error: {len(given_up)} work units failed {max_attempts} times, see {shared_path(shared_dir, 'failed')}: {', '.join(given_up)}")
+    if missing:
+        print(f"Error: {len(missing)} work units are not finished yet, e.g. {missing[0]}")
+    if given_up or missing:
+        return False
+
+    # A finished unit needs its shard, its aggregates when a report is requested and its run for a search index
+    incomplete = []
+    for unit_id in unit_ids:
+        required = [shared_path(shared_dir, "shards", f"{unit_id}.csv")]
+        if report_dir:
+            required.append(shared_path(shared_dir, "aggregates", f"{unit_id}.json"))
+        if search_index_dir:
+            required.append(shared_path(shared_dir, "search_runs", f"{unit_id}.tsv"))
+        if not all(os.path.exists(path) for path in required):
+            # Dropping the done marker makes the next worker run process the unit again
+            os.remove(shared_path(shared_dir, "done", f"{unit_id}.json"))
+            incomplete.append(unit_id)
+    if incomplete:
+        print(f"Error: {len(incomplete)} work units are missing output files and were reopened, run a worker again: {', '.join(incomplete)}")
+        return False
+
+    quarantined_count = 0
+    accumulator = AggregateAccumulator()
+    header = None
+    with open(output_path, "wb") as output_file:
+        for unit_id in unit_ids:
+            quarantined_count += read_json(shared_path(shared_dir, "done", f"{unit_id}.json")).get("quarantined", 0)
+            with open(shared_path(shared_dir, "shards", f"{unit_id}.csv"), "rb") as shard_file:
+                # Shards share the same header, keep only the first one
+                shard_header = shard_file.readline()
+                if header is None:
+                    header = shard_header
+                    output_file.write(header)
+                shutil.copyfileobj(shard_file, output_file)
+            if report_dir:
+                accumulator.update(AggregateAccumulator.load(shared_path(shared_dir, "aggregates", f"{unit_id}.json")))
+
+    print(f"{len(unit_ids)} shards merged into {output_path}")
+    if quarantined_count:
+        print(f"{quarantined_count} malformed releases were quarantined, see {shared_path(shared_dir, 'quarantine')}")
+
+    if report_dir:
+        # Summary tables come from the per unit counts, so the merged CSV is not read again
+        write_report(accumulator.summaries(), report_dir, report_format)
+
+    if search_index_dir:
+        # The index is merged from the per unit runs, so the merged CSV is not read again
+        run_paths = [shared_path(shared_dir, "search_runs", f"{unit_id}.tsv") for unit_id in unit_ids]
+        term_count = merge_runs(run_paths, search_index_dir)
+        print(f"Search index with {term_count} terms created in {search_index_dir}")
+    return True
+
+
+def run_local_worker(shared_dir, worker_id, poll_interval, settings):
+    # Child processes do not inherit module globals on every platform
+    global lease_timeout, max_attempts, retry_delay
+    lease_timeout, max_attempts, retry_delay = settings
+    run_worker(shared_dir, worker_id, poll_interval)
+
+
+def run_local(shared_dir, worker_count, poll_interval):
+    # Several worker processes on one machine, with shared_dir standing in for the shared mount
+    hostname = socket.gethostname()
+    workers = [
+        multiprocessing.Process(
+            target=run_local_worker,
+            args=(shared_dir, f"{hostname}-local-{number + 1}", poll_interval, (lease_timeout, max_attempts, retry_delay))
+        )
+        for number in range(worker_count)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def main():
+    global lease_timeout, max_attempts, retry_delay
+
+    parser = argparse.ArgumentParser(description="Distribute Discogs XML to CSV conversion over several machines.")
+    parser.add_argument("shared_dir", help="Folder on the shared filesystem used for coordination")
+    parser.add_argument("--lease-timeout", type=int, default=lease_timeout, help="Seconds before a silent worker's lease expires")
+    parser.add_argument("--max-attempts", type=int, default=max_attempts, help="Attempts per unit before workers give up on it")
+    parser.add_argument("--retry-delay", type=float, default=retry_delay, help="Seconds to wait before retrying a failed unit, per attempt")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name in ("plan", "local"):
+        command = commands.add_parser(name)
+        source = command.add_mutually_exclusive_group(required=True)
+        source.add_argument("--chunks", help="Folder of XML chunks created by discogs_xmlchunker")
+        source.add_argument("--xml", help="Uncompressed releases XML dump, split into byte ranges")
+        command.add_argument("--units", type=int, default=256, help="Number of byte ranges when --xml is used")
+        if name == "local":
+            command.add_argument("--workers", type=int, default=os.cpu_count())
+            command.add_argument("--output", default="discogs.csv")
+            command.add_argument("--search-index", help="Also build a full-text search index into this folder")
+            command.add_argument("--report", help="Also write the summary tables into this folder")
+            command.add_argument("--format", choices=["parquet", "csv"], default="parquet", help="Format of the summary tables written with --report")
+            command.add_argument("--poll-interval", type=float, default=1)
+
+    worker_command = commands.add_parser("worker")
+    worker_command.add_argument("--worker-id")
+    worker_command.add_argument("--poll-interval", type=float, default=10)
+
+    merge_command = commands.add_parser("merge")
+    merge_command.add_argument("--output", default="discogs.csv")
+    merge_command.add_argument("--search-index", help="Also build a full-text search index into this folder")
+    merge_command.add_argument("--report", help="Also write the summary tables into this folder")
+    merge_command.add_argument("--format", choices=["parquet", "csv"], default="parquet", help="Format of the summary tables written with --report")
+
+    args = parser.parse_args()
+    lease_timeout = args.lease_timeout
+    max_attempts = args.max_attempts
+    retry_delay = args.retry_delay
+    start_time = time.time()
+
+    if args.command == "plan":
+        plan(args.shared_dir, args.chunks, args.xml, args.units)
+    elif args.command == "worker":
+        run_worker(args.shared_dir, args.worker_id, args.poll_interval)
+    elif args.command == "merge":
+        merged = merge_shards(args.shared_dir, args.output, args.search_index, args.report, args.format)
+    else:
+        plan(args.shared_dir, args.chunks, args.xml, args.units)
+        run_local(args.shared_dir, args.workers, args.poll_interval)
+        merged = merge_shards(args.shared_dir, args.output, args.search_index, args.report, args.format)
+
+    elapsed_time = time.time() - start_time
+    hours, remainder = divmod(elapsed_time, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    print(f"Total elapsed time: {int(hours)} hours, {int(minutes)} minutes, {int(seconds)} seconds")
+    if args.command in ("merge", "local") and not merged:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import threading
+import multiprocessing
+
+from discogs_xml2csv_tr import parse_xml_data, write_quarantine, write_rows_csv
+from discogs_report_tr import AggregateAccumulator, write_report
+from discogs_search_index_tr import merge_runs, write_rows_run
+
+# Tüm düğümlerin erişebilmesi gereken paylaşımlı klasörün yapısı (NFS, SMB, ...):
+#   units/   koordinatörün yazdığı, her iş birimi için bir JSON tanımı
+#   leases/  bir işçi tarafından işlenmekte olan her birim için bir kira dosyası
+#   shards/  tamamlanan her birim için bir CSV
+#   done/    tamamlanan her birim için, CSV'si yerine konduktan sonra yazılan bir işaret
+#   failed/  son denemesi başarısız olan her birim için bir işaret, max_attempts'e ulaşana kadar yeniden denenir
+#   quarantine/  bir birimin hatalı kayıtları, konumları ve hatalarıyla birlikte
+#   aggregates/  bir birimin özet sayımları, birleştirme adımında toplanır
+#   search_runs/ bir birimin sıralı arama dizini ara dosyası, birleştirme adımında tek bir dizinde birleştirilir
+lease_timeout = 600  # Sinyal gelmeyen bir kiranın süresi dolmuş sayılmadan önce geçen saniye
+max_attempts = 3  # İşçiler bir birimden vazgeçmeden önceki deneme sayısı
+retry_delay = 30  # Başarısız bir denemeden sonra beklenecek saniye, deneme sayısıyla çarpılır
+release_marker = b"<release id="
+read_block_size = 1024 * 1024
+
+
+def shared_path(shared_dir, *parts):
+    return os.path.join(shared_dir, *parts)
+
+
+def prepare_shared_dir(shared_dir):
+    for folder in ("units", "leases", "shards", "done", "failed", "quarantine", "aggregates", "search_runs"):
+        os.makedirs(shared_path(shared_dir, folder), exist_ok=True)
+
+
+def write_json_atomic(path, data):
+    # Diğer düğümler yarım yazılmış bir dosya görmesin diye önce özel bir geçici dosyaya yaz
+    temp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as json_file:
+        json.dump(data, json_file)
+    os.replace(temp_path, path)
+
+
+def read_json(path):
+    with open(path, "r", encoding="utf-8") as json_file:
+        return json.load(json_file)
+
+
+def list_unit_ids(shared_dir):
+    return sorted(file[:-5] for file in os.listdir(shared_path(shared_dir, "units")) if file.endswith(".json"))
+
+
+def is_unit_done(shared_dir, unit_id):
+    return os.path.exists(shared_path(shared_dir, "done", f"{unit_id}.json"))
+
+
+def read_failure(shared_dir, unit_id):
+    # Bir birimin hata işareti, son denemesi başarısız olmadıysa None
+    try:
+        return read_json(shared_path(shared_dir, "failed", f"{unit_id}.json"))
+    except FileNotFoundError:
+        return None
+
+
+def is_unit_given_up(shared_dir, unit_id):
+    failure = read_failure(shared_dir, unit_id)
+    return failure is not None and failure["attempts"] >= max_attempts
+
+
+def is_retry_due(shared_dir, unit_id):
+    failure = read_failure(shared_dir, unit_id)
+    return failure is None or time.time() - failure["failed_at"] >= retry_delay * failure["attempts"]
+
+
+def plan_chunk_units(chunk_folder):
+    # discogs_xmlchunker'ın ürettiği her dosya bir iş birimidir
+    units = []
+    for file_name in sorted(os.listdir(chunk_folder)):
+        if file_name.endswith(".xml"):
+            units.append({
+                "unit_id": file_name[:-4], "kind": "file",
+                "path": os.path.abspath(os.path.join(chunk_folder, file_name))
+            })
+    return units
+
+
+def find_release_start(data_file, offset, data_end):
+    # offset'ten itibaren ilk "<release id=" konumunu, yoksa data_end değerini döndür
+    data_file.seek(offset)
+    position = offset
+    carry = b""
+    while position < data_end:
+        block = data_file.read(read_block_size)
+        if not block:
+            break
+        buffered = carry + block
+        index = buffered.find(release_marker)
+        if index != -1:
+            return min(position - len(carry) + index, data_end)
+        carry = buffered[-(len(release_marker) - 1):]
+        position += len(block)
+    return data_end
+
+
+def find_data_end(data_file):
+    # Kayıtlar kapanış </releases> etiketinin başladığı yerde biter
+    file_size = os.fstat(data_file.fileno()).st_size
+    tail_start = max(file_size - read_block_size, 0)
+    data_file.seek(tail_start)
+    index = data_file.read().rfind(b"</releases>")
+    if index == -1:
+        return file_size
+    return tail_start + index
+
+
+def plan_range_units(xml_path, unit_count):
+    # Sıkıştırılmamış dökümü <release> sınırlarına hizalı unit_count adet bayt aralığına böl
+    xml_path = os.path.abspath(xml_path)
+    with open(xml_path, "rb") as data_file:
+        data_end = find_data_end(data_file)
+        starts = set()
+        for unit_number in range(unit_count):
+            starts.add(find_release_start(data_file, data_end * unit_number // unit_count, data_end))
+    starts = sorted(start for start in starts if start < data_end)
+
+    units = []
+    for unit_number, start in enumerate(starts):
+        end = starts[unit_number + 1] if unit_number + 1 < len(starts) else data_end
+        units.append({
+            "unit_id": f"range_{unit_number + 1:05d}", "kind": "range",
+            "path": xml_path, "start": start, "end": end
+        })
+    return units
+
+
+def plan(shared_dir, chunk_folder=None, xml_path=None, unit_count=None):
+    prepare_shared_dir(shared_dir)
+    if list_unit_ids(shared_dir):
+        print("İş birimleri zaten planlanmış, yeniden kullanılıyor.")
+        return
+
+    if chunk_folder is not None:
+        units = plan_chunk_units(chunk_folder)
+    else:
+        units = plan_range_units(xml_path, unit_count)
+
+    for unit in units:
+        write_json_atomic(shared_path(shared_dir, "units", f"{unit['unit_id']}.json"), unit)
+    print(f"{len(units)} iş birimi planlandı.")
+
+
+def reclaim_expired_lease(lease_path, worker_id):
+    # Kira ortadan kalktığında ve talep denenebileceğinde True döndürür
+    try:
+        lease_age = time.time() - os.stat(lease_path).st_mtime
+    except FileNotFoundError:
+        return True
+    if lease_age < lease_timeout:
+        return False
+
+    # Yeniden adlandırma atomiktir, bu yüzden süresi dolan kirayı yalnızca bir işçi kazanır
+    expired_path = f"{lease_path}.expired.{worker_id}"
+    try:
+        os.rename(lease_path, expired_path)
+    except FileNotFoundError:
+        return True
+
+    # Başka bir işçi stat ile rename arasında kirayı yenilemiş olabilir; taze kirayı geri ver
+    if time.time() - os.stat(expired_path).st_mtime < lease_timeout:
+        try:
+            os.link(expired_path, lease_path)
+        except FileExistsError:
+            pass
+        os.remove(expired_path)
+        return False
+
+    os.remove(expired_path)
+    print(f"{worker_id}: süresi dolan kira geri alındı: {os.path.basename(lease_path)}")
+    return True
+
+
+def claim_unit(shared_dir, unit_id, worker_id):
+    lease_path = shared_path(shared_dir, "leases", f"{unit_id}.lease")
+    if os.path.exists(lease_path) and not reclaim_expired_lease(lease_path, worker_id):
+        return False
+    try:
+        # O_EXCL oluşturmayı atomik yapar: kirayı tam olarak bir işçi alır
+        lease_fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(lease_fd, "w", encoding="utf-8") as lease_file:
+        json.dump({"worker_id": worker_id, "claimed_at": time.time()}, lease_file)
+
+    # Birim, listeleme ile talep arasında tamamlanmış olabilir
+    if is_unit_done(shared_dir, unit_id):
+        os.remove(lease_path)
+        return False
+    return True
+
+
+def read_lease_owner(lease_path):
+    # Kiraya yazılan worker_id, sahibi kirayı henüz yazıyorsa None
+    try:
+        return read_json(lease_path)["worker_id"]
+    except ValueError:
+        # Yeni oluşturulan kira, sahibi yazana kadar boştur
+        return None
+
+
+def keep_lease_alive(lease_path, worker_id, stop_event):
+    # Diğer işçiler geri almasın diye kiranın değiştirilme zamanını yenile
+    while not stop_event.wait(lease_timeout / 4):
+        try:
+            if read_lease_owner(lease_path) != worker_id:
+                # Kiranın süresi doldu ve geri alındı, artık başka bir işçiye ait
+                print(f"{worker_id}: kira başka bir işçiye geçti: {os.path.basename(lease_path)}")
+                return
+            os.utime(lease_path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            # Ağ dosya sistemleri geçici hatalar (ESTALE, EIO) bildirir; kalp atışı devam etmeli
+            print(f"{worker_id}: kira yenilenemedi {os.path.basename(lease_path)}: {str(e)}")
+
+
+def release_lease(lease_path, worker_id):
+    # Kira yalnızca hâlâ bize aitse silinir, geri alınan kira yeni sahibine aittir
+    try:
+        if read_lease_owner(lease_path) == worker_id:
+            os.remove(lease_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"{worker_id}: kira bırakılamadı {os.path.basename(lease_path)}, süresi dolacak: {str(e)}")
+
+
+def read_unit_data(unit):
+    with open(unit["path"], "rb") as data_file:
+        if unit["kind"] == "range":
+            data_file.seek(unit["start"])
+            return data_file.read(unit["end"] - unit["start"])
+        return data_file.read()
+
+
+def process_unit(shared_dir, unit_id, worker_id):
+    lease_path = shared_path(shared_dir, "leases", f"{unit_id}.lease")
+    stop_event = threading.Event()
+    heartbeat = threading.Thread(target=keep_lease_alive, args=(lease_path, worker_id, stop_event), daemon=True)
+    heartbeat.start()
+
+    start_time = time.time()
+    done_marker = {"unit_id": unit_id, "worker_id": worker_id}
+    failure_path = shared_path(shared_dir, "failed", f"{unit_id}.json")
+    try:
+        unit = read_json(shared_path(shared_dir, "units", f"{unit_id}.json"))
+        rows, quarantined = parse_xml_data(read_unit_data(unit), unit_id, unit.get("start", 0))
+        write_quarantine(quarantined, shared_path(shared_dir, "quarantine", f"{unit_id}.jsonl"))
+
+        # Özetler ve arama ara dosyası parçadan önce yerine konur, böylece birleştirmenin gördüğü her parçada bunlar vardır
+        accumulator = AggregateAccumulator()
+        accumulator.add_rows(rows)
+        aggregates_path = shared_path(shared_dir, "aggregates", f"{unit_id}.json")
+        accumulator.save(f"{aggregates_path}.{worker_id}.tmp")
+        os.replace(f"{aggregates_path}.{worker_id}.tmp", aggregates_path)
+        run_path = shared_path(shared_dir, "search_runs", f"{unit_id}.tsv")
+        write_rows_run(rows, f"{run_path}.{worker_id}.tmp")
+        os.replace(f"{run_path}.{worker_id}.tmp", run_path)
+
+        # Parçalar özel bir adla yazılıp yerine taşınır, böylece iki kez işlenen bir birim de tutarlı kalır
+        shard_path = shared_path(shared_dir, "shards", f"{unit_id}.csv")
+        temp_path = f"{shard_path}.{worker_id}.tmp"
+        write_rows_csv(rows, temp_path)
+        os.replace(temp_path, shard_path)
+        done_marker["rows"] = len(rows)
+        done_marker["quarantined"] = len(quarantined)
+        succeeded = True
+    except Exception as e:
+        print(f'Hata: {unit_id} işlenirken bir hata oluştu: {str(e)}')
+        failure = read_failure(shared_dir, unit_id) or {"attempts": 0}
+        failure.update(unit_id=unit_id, worker_id=worker_id, error=str(e), failed_at=time.time())
+        failure["attempts"] += 1
+        succeeded = False
+    finally:
+        stop_event.set()
+        heartbeat.join()
+
+    done_marker["elapsed_seconds"] = round(time.time() - start_time, 2)
+    if succeeded:
+        write_json_atomic(shared_path(shared_dir, "done", f"{unit_id}.json"), done_marker)
+        try:
+            os.remove(failure_path)
+        except FileNotFoundError:
+            pass
+        print(f"{worker_id}: {unit_id} {done_marker['elapsed_seconds']:.0f} saniyede tamamlandı")
+    else:
+        # Tamamlandı işareti yok: birim beklemede kalır ve retry_delay sonrasında herhangi bir işçi tarafından yeniden denenir
+        write_json_atomic(failure_path, failure)
+        print(f"{worker_id}: {unit_id} başarısız oldu, deneme {failure['attempts']} / {max_attempts}")
+    release_lease(lease_path, worker_id)
+    return succeeded
+
+
+def run_worker(shared_dir, worker_id=None, poll_interval=10):
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    processed_count = 0
+
+    while True:
+        pending = [
+            unit_id for unit_id in list_unit_ids(shared_dir)
+            if not is_unit_done(shared_dir, unit_id) and not is_unit_given_up(shared_dir, unit_id)
+        ]
+        if not pending:
+            break
+
+        claimed_any = False
+        for unit_id in pending:
+            if is_retry_due(shared_dir, unit_id) and claim_unit(shared_dir, unit_id, worker_id):
+                if process_unit(shared_dir, unit_id, worker_id):
+                    processed_count += 1
+                claimed_any = True
+
+        # Kalan birimler başka işçilerde ya da yeniden denenmeyi bekliyor
+        if not claimed_any:
+            time.sleep(poll_interval)
+
+    given_up = [unit_id for unit_id in list_unit_ids(shared_dir) if is_unit_given_up(shared_dir, unit_id)]
+    print(f"{worker_id}: {processed_count} birim işlendi, iş kalmadı.")
+    if given_up:
+        print(f"Hata: {len(given_up)} iş birimi {max_attempts} kez başarısız oldu ve vazgeçildi, "
+              f"yeniden denemek için işaretlerini {shared_path(shared_dir, 'failed')} klasöründen silin: {', '.join(given_up)}")
+
+
+def merge_shards(shared_dir, output_path, search_index_dir=None, report_dir=None, report_format="parquet"):
+    # Bir birim tamamlanmamış, başarısız ya da eksikse hiçbir şey yazmadan False döndürür
+    unit_ids = list_unit_ids(shared_dir)
+    given_up = [unit_id for unit_id in unit_ids if is_unit_given_up(shared_dir, unit_id)]
+    missing = [unit_id for unit_id in unit_ids if not is_unit_done(shared_dir, unit_id) and unit_id not in given_up]
+    if given_up:
+        print(f"Hata: {len(given_up)} iş birimi {max_attempts} kez başarısız oldu, bkz. {shared_path(shared_dir, 'failed')}: {', '.join(given_up)}")
+    if missing:
+        print(f"Hata: {len(missing)} iş birimi henüz tamamlanmadı, örn. {missing[0]}")
+    if given_up or missing:
+        return False
+
+    # Tamamlanan bir birimin parçası, rapor istendiğinde özetleri, arama dizini istendiğinde ara dosyası olmalıdır
+    incomplete = []
+    for unit_id in unit_ids:
+        required = [shared_path(shared_dir, "shards", f"{unit_id}.csv")]
+        if report_dir:
+            required.append(shared_path(shared_dir, "aggregates", f"{unit_id}.json"))
+        if search_index_dir:
+            required.append(shared_path(shared_dir, "search_runs", f"{unit_id}.tsv"))
+        if not all(os.path.exists(path) for path in required):
+            # Tamamlandı işaretini silmek, bir sonraki işçi çalışmasının birimi yeniden işlemesini sağlar
+            os.remove(shared_path(shared_dir, "done", f"{unit_id}.json"))
+            incomplete.append(unit_id)
+    if incomplete:
+        print(f"Hata: {len(incomplete)} iş biriminin çıktı dosyaları eksik ve yeniden açıldı, bir işçiyi tekrar çalıştırın: {', '.join(incomplete)}")
+        return False
+
+    quarantined_count = 0
+    accumulator = AggregateAccumulator()
+    header = None
+    with open(output_path, "wb") as output_file:
+        for unit_id in unit_ids:
+            quarantined_count += read_json(shared_path(shared_dir, "done", f"{unit_id}.json")).get("quarantined", 0)
+            with open(shared_path(shared_dir, "shards", f"{unit_id}.csv"), "rb") as shard_file:
+                # Parçalar aynı başlığı paylaşır, yalnızca ilkini koru
+                shard_header = shard_file.readline()
+                if header is None:
+                    header = shard_header
+                    output_file.write(header)
+                shutil.copyfileobj(shard_file, output_file)
+            if report_dir:
+                accumulator.update(AggregateAccumulator.load(shared_path(shared_dir, "aggregates", f"{unit_id}.json")))
+
+    print(f"{len(unit_ids)} parça {output_path} dosyasında birleştirildi")
+    if quarantined_count:
+        print(f"{quarantined_count} hatalı kayıt karantinaya alındı, bkz. {shared_path(shared_dir, 'quarantine')}")
+
+    if report_dir:
+        # Özet tablolar birim başına sayımlardan gelir, böylece birleştirilmiş CSV yeniden okunmaz
+        write_report(accumulator.summaries(), report_dir, report_format)
+
+    if search_index_dir:
+        # Dizin birim başına ara dosyalardan birleştirilir, böylece birleştirilmiş CSV yeniden okunmaz
+        run_paths = [shared_path(shared_dir, "search_runs", f"{unit_id}.tsv") for unit_id in unit_ids]
+        term_count = merge_runs(run_paths, search_index_dir)
+        print(f"{term_count} terimli arama dizini {search_index_dir} klasöründe oluşturuldu")
+    return True
+
+
+def run_local_worker(shared_dir, worker_id, poll_interval, settings):
+    # Alt süreçler modül değişkenlerini her platformda devralmaz
+    global lease_timeout, max_attempts, retry_delay
+    lease_timeout, max_attempts, retry_delay = settings
+    run_worker(shared_dir, worker_id, poll_interval)
+
+
+def run_local(shared_dir, worker_count, poll_interval):
+    # Tek makinede birden fazla işçi süreci; shared_dir paylaşımlı bağlantının yerini tutar
+    hostname = socket.gethostname()
+    workers = [
+        multiprocessing.Process(
+            target=run_local_worker,
+            args=(shared_dir, f"{hostname}-local-{number + 1}", poll_interval, (lease_timeout, max_attempts, retry_delay))
+        )
+        for number in range(worker_count)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def main():
+    global lease_timeout, max_attempts, retry_delay
+
+    parser = argparse.ArgumentParser(description="Discogs XML'den CSV'ye dönüşümü birden fazla makineye dağıt.")
+    parser.add_argument("shared_dir", help="Koordinasyon için kullanılan paylaşımlı dosya sistemindeki klasör")
+    parser.add_argument("--lease-timeout", type=int, default=lease_timeout, help="Sessiz kalan bir işçinin kirasının dolması için geçen saniye")
+    parser.add_argument("--max-attempts", type=int, default=max_attempts, help="İşçiler bir birimden vazgeçmeden önceki deneme sayısı")
+    parser.add_argument("--retry-delay", type=float, default=retry_delay, help="Başarısız bir birimi yeniden denemeden önce deneme başına beklenecek saniye")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name in ("plan", "local"):
+        command = commands.add_parser(name)
+        source = command.add_mutually_exclusive_group(required=True)
+        source.add_argument("--chunks", help="discogs_xmlchunker ile oluşturulan XML parçalarının klasörü")
+        source.add_argument("--xml", help="Bayt aralıklarına bölünecek sıkıştırılmamış releases XML dökümü")
+        command.add_argument("--units", type=int, default=256, help="--xml kullanıldığında bayt aralığı sayısı")
+        if name == "local":
+            command.add_argument("--workers", type=int, default=os.cpu_count())
+            command.add_argument("--output", default="discogs.csv")
+            command.add_argument("--search-index", help="Ayrıca bu klasöre bir tam metin arama dizini oluştur")
+            command.add_argument("--report", help="Ayrıca özet tabloları bu klasöre yaz")
+            command.add_argument("--format", choices=["parquet", "csv"], default="parquet", help="--report ile yazılan özet tabloların biçimi")
+            command.add_argument("--poll-interval", type=float, default=1)
+
+    worker_command = commands.add_parser("worker")
+    worker_command.add_argument("--worker-id")
+    worker_command.add_argument("--poll-interval", type=float, default=10)
+
+    merge_command = commands.add_parser("merge")
+    merge_command.add_argument("--output", default="discogs.csv")
+    merge_command.add_argument("--search-index", help="Ayrıca bu klasöre bir tam metin arama dizini oluştur")
+    merge_command.add_argument("--report", help="Ayrıca özet tabloları bu klasöre yaz")
+    merge_command.add_argument("--format", choices=["parquet", "csv"], default="parquet", help="--report ile yazılan özet tabloların biçimi")
+
+    args = parser.parse_args()
+    lease_timeout = args.lease_timeout
+    max_attempts = args.max_attempts
+    retry_delay = args.retry_delay
+    start_time = time.time()
+
+    if args.command == "plan":
+        plan(args.shared_dir, args.chunks, args.xml, args.units)
+    elif args.command == "worker":
+        run_worker(args.shared_dir, args.worker_id, args.poll_interval)
+    elif args.command == "merge":
+        merged = merge_shards(args.shared_dir, args.output, args.search_index, args.report, args.format)
+    else:
+        plan(args.shared_dir, args.chunks, args.xml, args.units)
+        run_local(args.shared_dir, args.workers, args.poll_interval)
+        merged = merge_shards(args.shared_dir, args.output, args.search_index, args.report, args.format)
+
+    elapsed_time = time.time() - start_time
+    hours, remainder = divmod(elapsed_time, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    print(f"Toplam geçen süre: {int(hours)} saat, {int(minutes)} dakika, {int(seconds)} saniye")
+    if args.command in ("merge", "local") and not merged:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
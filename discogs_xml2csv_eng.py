@@ -1,72 +1,198 @@
 import os
+import re
+import json
 import polars as pl
 from lxml import etree
 import time
 import concurrent.futures
 
+from discogs_report_eng import AggregateAccumulator, write_report
+from discogs_search_index_eng import SearchIndexBuilder
 
-def process_xml_file(file_name):
-    file_path = os.path.join(folder_path, file_name)
+
+# Path to the folder you want to process
+folder_path = 'chunked'
+
+# Folder where malformed releases are written together with their offset and error
+quarantine_folder = 'quarantine'
+
+# Folder of the full-text search index built while the chunks are processed, None to skip it
+search_index_folder = 'search_index'
+
+# Folder of the summary tables kept up to date while the chunks are processed, None to skip them
+report_folder = 'reports'
+# Format of the summary tables, "parquet" or "csv"
+report_format = 'parquet'
+
+release_start = re.compile(rb"<release id=")
+release_id_pattern = re.compile(rb'<release id="([^"]*)"')
+
+# Column order of the produced CSV
+columns = [
+    "release_id", "status", "title", "artist_id", "artist_name", "label_name", "label_id",
+    "format", "genre", "style", "country", "release_date", "notes", "master_id",
+    "video_url", "company_name"
+]
+
+
+def parse_release(release):
+    release_id = release.get("id")
+    status = release.get("status")
+    title = release.findtext("title") or ""
+    artist_id = release.findtext(".//artist/id") or ""
+    artist_name = release.findtext(".//artist/name") or ""
+    label_elem = release.find(".//labels/label")
+    if label_elem is not None:
+        label_name = label_elem.get("name")
+        label_id = label_elem.get("id")
+    else:
+        label_name = ""
+        label_id = ""
+
+    format_elem = release.find(".//formats/format")
+    if format_elem is not None:
+        format = format_elem.get("name")
+    else:
+        format = ""
+
+    genre = release.findtext(".//genres/genre") or ""
+    style = release.findtext(".//styles/style") or ""
+    country = release.findtext("country") or ""
+    release_date = release.findtext("released") or ""
+    notes = release.findtext("notes") or ""
+    master_id_elem = release.find(".//master_id[@is_main_release='true']")
+    if master_id_elem is not None:
+        master_id = master_id_elem.text
+    else:
+        master_id = ""
+
+    video_elem = release.find(".//videos/video")
+    if video_elem is not None:
+        video_url = video_elem.get("src")
+    else:
+        video_url = ""
+
+    company_name_elem = release.find(".//companies/company/name")
+    if company_name_elem is not None:
+        company_name = company_name_elem.text
+    else:
+        company_name = ""
+
+    # Store each row as a dictionary
+    row = {
+        "release_id": release_id, "status": status, "title": title, "artist_id": artist_id,
+        "artist_name": artist_name, "label_name": label_name, "label_id": label_id,
+        "format": format, "genre": genre, "style": style, "country": country,
+        "release_date": release_date, "notes": notes, "master_id": master_id,
+        "video_url": video_url, "company_name": company_name
+    }
+    return row
+
+
+def split_releases(data):
+    # Yield (offset, bytes) for every <release> element found in data
+    starts = [match.start() for match in release_start.finditer(data)]
+    for index, start in enumerate(starts):
+        end = starts[index + 1] if index + 1 < len(starts) else len(data)
+        segment = data[start:end]
+        close = segment.rfind(b"</release>")
+        if close != -1:
+            segment = segment[:close + len(b"</release>")]
+        yield start, segment
+
+
+def parse_release_alone(segment):
+    # Reparse a single release, falling back to recover mode only for this release
     try:
-        parser = etree.XMLParser(recover=True)  # Use recover=True to process XML files with errors
-        tree = etree.parse(file_path, parser=parser)
-        root = tree.getroot()
+        return etree.fromstring(segment, parser=etree.XMLParser(recover=False)), None
+    except etree.XMLSyntaxError as e:
+        release = etree.fromstring(segment, parser=etree.XMLParser(recover=True))
+        if release is None or release.tag != "release" or release.get("id") is None:
+            release = None
+        return release, e
+
+
+def quarantine_record(source_name, offset, segment, error, action):
+    match = release_id_pattern.search(segment)
+    return {
+        "source": source_name, "offset": offset,
+        "release_id": match.group(1).decode() if match else None,
+        "error": str(error), "action": action,
+        "xml": segment.decode("utf-8", errors="replace")
+    }
 
-        rows = []  # Create a list to store rows from each file
 
+def parse_xml_data(data, source_name="", base_offset=0):
+    # data holds one or more <release> elements, either a whole chunk file or a byte range of the dump.
+    # Returns the parsed rows and the quarantined releases that could not be parsed cleanly.
+    rows = []  # Create a list to store rows from each file
+    quarantined = []
+
+    wrapped = data
+    if not data.lstrip().startswith(b"<root>"):
+        wrapped = b"<root>\n" + data + b"</root>\n"
+    try:
+        # Fast path: a strict parse of the whole chunk
+        root = etree.fromstring(wrapped, parser=etree.XMLParser(recover=False))
         for release in root.xpath(".//release"):
-            release_id = release.get("id")
-            status = release.get("status")
-            title = release.findtext("title") or ""
-            artist_id = release.findtext(".//artist/id") or ""
-            artist_name = release.findtext(".//artist/name") or ""
-            label_elem = release.find(".//labels/label")
-            if label_elem is not None:
-                label_name = label_elem.get("name")
-                label_id = label_elem.get("id")
-            else:
-                label_name = ""
-                label_id = ""
-
-            format_elem = release.find(".//formats/format")
-            if format_elem is not None:
-                format = format_elem.get("name")
-            else:
-                format = ""
-
-            genre = release.findtext(".//genres/genre") or ""
-            style = release.findtext(".//styles/style") or ""
-            country = release.findtext("country") or ""
-            release_date = release.findtext("released") or ""
-            notes = release.findtext("notes") or ""
-            master_id_elem = release.find(".//master_id[@is_main_release='true']")
-            if master_id_elem is not None:
-                master_id = master_id_elem.text
-            else:
-                master_id = ""
-
-            video_elem = release.find(".//videos/video")
-            if video_elem is not None:
-                video_url = video_elem.get("src")
-            else:
-                video_url = ""
-
-            company_name_elem = release.find(".//companies/company/name")
-            if company_name_elem is not None:
-                company_name = company_name_elem.text
-            else:
-                company_name = ""
-
-            # Store each row as a dictionary
-            row = {
-                "release_id": release_id, "status": status, "title": title, "artist_id": artist_id,
-                "artist_name": artist_name, "label_name": label_name, "label_id": label_id,
-                "format": format, "genre": genre, "style": style, "country": country,
-                "release_date": release_date, "notes": notes, "master_id": master_id,
-                "video_url": video_url, "company_name": company_name
-            }
-            rows.append(row)
+            try:
+                rows.append(parse_release(release))
+            except Exception as e:
+                segment = etree.tostring(release)
+                # The strict parse keeps no byte positions, so find the release in data by its id
+                offset = data.find(b'<release id="%s"' % release.get("id", "").encode())
+                offset = base_offset + offset if offset != -1 else None
+                quarantined.append(quarantine_record(source_name, offset, segment, e, "dropped"))
+        return rows, quarantined
+    except etree.XMLSyntaxError:
+        pass
+
+    # Slow path: only the malformed releases are reparsed in recover mode, the rest of the chunk continues
+    for offset, segment in split_releases(data):
+        offset += base_offset
+        try:
+            release, error = parse_release_alone(segment)
+            if release is None:
+                quarantined.append(quarantine_record(source_name, offset, segment, error, "dropped"))
+                continue
+            rows.append(parse_release(release))
+            if error is not None:
+                quarantined.append(quarantine_record(source_name, offset, segment, error, "recovered"))
+        except Exception as e:
+            quarantined.append(quarantine_record(source_name, offset, segment, e, "dropped"))
+
+    return rows, quarantined
+
+
+def write_quarantine(quarantined, output_path):
+    # One JSON line per malformed release, with enough context to fix and rerun it alone
+    if not quarantined:
+        # A clean run removes the quarantine file left by an earlier run
+        try:
+            os.remove(output_path)
+        except FileNotFoundError:
+            pass
+        return
+    with open(output_path, "w", encoding="utf-8") as quarantine_file:
+        for record in quarantined:
+            quarantine_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
 
+def write_rows_csv(rows, output_path):
+    # A fixed schema keeps empty outputs and column order consistent between files
+    df = pl.DataFrame(rows, schema={column: pl.String for column in columns})
+    df.write_csv(output_path)
+
+
+def process_xml_file(file_name):
+    file_path = os.path.join(folder_path, file_name)
+    try:
+        with open(file_path, "rb") as xml_file:
+            rows, quarantined = parse_xml_data(xml_file.read(), file_name)
+        os.makedirs(quarantine_folder, exist_ok=True)
+        write_quarantine(quarantined, os.path.join(quarantine_folder, f"{file_name[:-4]}.jsonl"))
+        if quarantined:
+            print(f"{file_name}: {len(quarantined)} malformed releases written to {quarantine_folder}")
         return rows
     except Exception as e:
         print(f'Error: An error occurred while processing {file_name}: {str(e)}')
@@ -77,56 +203,69 @@ def print_processed_count(processed_count):
     print(f"{processed_count} files processed...")
 
 
-# Path to the folder you want to process
-folder_path = 'chunked'
+def main():
+    # List XML files in the folder
+    file_list = [file for file in os.listdir(folder_path) if file.endswith('.xml')]
+
+    # File counter
+    file_counter = 0
+
+    # Elapsed time counters
+    total_elapsed_time = 0
 
-# List XML files in the folder
-file_list = [file for file in os.listdir(folder_path) if file.endswith('.xml')]
+    # Create a list to store data
+    data_list = []
 
-# File counter
-file_counter = 0
+    # Feed the search index and the summary tables as chunks complete, so no second pass over the CSV is needed
+    index_builder = SearchIndexBuilder(search_index_folder) if search_index_folder else None
+    accumulator = AggregateAccumulator() if report_folder else None
 
-# Elapsed time counters
-total_elapsed_time = 0
+    # Use ThreadPoolExecutor for parallel processing
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = []
 
-# Create a list to store data
-data_list = []
+        for file_name in file_list:
+            file_counter += 1
+            print(f"Processing file {file_counter}...")
 
-# Use ThreadPoolExecutor for parallel processing
-with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-    futures = []
+            start_time = time.time()  # Start time of processing
 
-    for file_name in file_list:
-        file_counter += 1
-        print(f"Processing file {file_counter}...")
+            # Start processing in parallel
+            future = executor.submit(process_xml_file, file_name)
+            futures.append(future)
 
-        start_time = time.time()  # Start time of processing
+        processed_count = 0  # Counter to track processed files
 
-        # Start processing in parallel
-        future = executor.submit(process_xml_file, file_name)
-        futures.append(future)
+        # Create a set to quickly track the processed file count when processing is completed
+        processed_set = set()
 
-    processed_count = 0  # Counter to track processed files
+        for future in concurrent.futures.as_completed(futures):
+            rows = future.result()
+            if rows is not None:
+                # Append each row in the list to data_list
+                data_list.extend(rows)
+                if index_builder is not None:
+                    index_builder.add_rows(rows)
+                if accumulator is not None:
+                    accumulator.add_rows(rows)
+                processed_count += 1
+                processed_set.add(processed_count)  # Add the processed file count
+                print_processed_count(processed_count)  # Print the processed file count to the screen
 
-    # Create a set to quickly track the processed file count when processing is completed
-    processed_set = set()
+    # Convert data_list to a Polars DataFrame and write it to a CSV file
+    write_rows_csv(data_list, "discogs.csv")
 
-    for future in concurrent.futures.as_completed(futures):
-        rows = future.result()
-        if rows is not None:
-            # Append each row in the list to data_list
-            data_list.extend(rows)
-            processed_count += 1
-            processed_set.add(processed_count)  # Add the processed file count
-            print_processed_count(processed_count)  # Print the processed file count to the screen
+    if index_builder is not None:
+        term_count = index_builder.finish()
+        print(f"Search index with {term_count} terms created in {search_index_folder}")
 
-# Convert data_list to a Polars DataFrame
-df = pl.DataFrame(data_list)
+    if accumulator is not None:
+        write_report(accumulator.summaries(), report_folder, report_format)
 
-# Write the Polars DataFrame to a CSV file
-df.write_csv("discogs.csv")
+    # Print the processing time and file count
+    print(f"Total {file_counter} XML files processed.")
+    print(f"Total processing time: {total_elapsed_time:.2f} seconds")
 
-# Print the processing time and file count
-print(f"Total {file_counter} XML files processed.")
-print(f"Total processing time: {total_elapsed_time:.2f} seconds")
 
+if __name__ == "__main__":
+    main()
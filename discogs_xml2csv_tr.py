@@ -1,72 +1,198 @@
 import os
+import re
+import json
 import polars as pl
 from lxml import etree
 import time
 import concurrent.futures
 
+from discogs_report_tr import AggregateAccumulator, write_report
+from discogs_search_index_tr import SearchIndexBuilder
 
-def process_xml_file(dosya_adi):
-    dosya_yolu = os.path.join(klasor_yolu, dosya_adi)
+
+# İşlem yapmak istediğiniz klasörün yolu
+klasor_yolu = 'chunked'
+
+# Hatalı kayıtların konumları ve hatalarıyla birlikte yazıldığı klasör
+quarantine_folder = 'quarantine'
+
+# Parçalar işlenirken oluşturulan tam metin arama dizininin klasörü, atlamak için None
+search_index_folder = 'search_index'
+
+# Parçalar işlenirken güncel tutulan özet tabloların klasörü, atlamak için None
+report_folder = 'reports'
+# Özet tabloların biçimi, "parquet" veya "csv"
+report_format = 'parquet'
+
+release_start = re.compile(rb"<release id=")
+release_id_pattern = re.compile(rb'<release id="([^"]*)"')
+
+# Oluşturulan CSV'nin sütun sırası
+columns = [
+    "release_id", "status", "title", "artist_id", "artist_name", "label_name", "label_id",
+    "format", "genre", "style", "country", "release_date", "notes", "master_id",
+    "video_url", "company_name"
+]
+
+
+def parse_release(release):
+    release_id = release.get("id")
+    status = release.get("status")
+    title = release.findtext("title") or ""
+    artist_id = release.findtext(".//artist/id") or ""
+    artist_name = release.findtext(".//artist/name") or ""
+    label_elem = release.find(".//labels/label")
+    if label_elem is not None:
+        label_name = label_elem.get("name")
+        label_id = label_elem.get("id")
+    else:
+        label_name = ""
+        label_id = ""
+
+    format_elem = release.find(".//formats/format")
+    if format_elem is not None:
+        format = format_elem.get("name")
+    else:
+        format = ""
+
+    genre = release.findtext(".//genres/genre") or ""
+    style = release.findtext(".//styles/style") or ""
+    country = release.findtext("country") or ""
+    release_date = release.findtext("released") or ""
+    notes = release.findtext("notes") or ""
+    master_id_elem = release.find(".//master_id[@is_main_release='true']")
+    if master_id_elem is not None:
+        master_id = master_id_elem.text
+    else:
+        master_id = ""
+
+    video_elem = release.find(".//videos/video")
+    if video_elem is not None:
+        video_url = video_elem.get("src")
+    else:
+        video_url = ""
+
+    company_name_elem = release.find(".//companies/company/name")
+    if company_name_elem is not None:
+        company_name = company_name_elem.text
+    else:
+        company_name = ""
+
+    # Her satırı bir sözlük olarak saklayın
+    row = {
+        "release_id": release_id, "status": status, "title": title, "artist_id": artist_id,
+        "artist_name": artist_name, "label_name": label_name, "label_id": label_id,
+        "format": format, "genre": genre, "style": style, "country": country,
+        "release_date": release_date, "notes": notes, "master_id": master_id,
+        "video_url": video_url, "company_name": company_name
+    }
+    return row
+
+
+def split_releases(data):
+    # data içinde bulunan her <release> öğesi için (konum, bayt) döndürün
+    starts = [match.start() for match in release_start.finditer(data)]
+    for index, start in enumerate(starts):
+        end = starts[index + 1] if index + 1 < len(starts) else len(data)
+        segment = data[start:end]
+        close = segment.rfind(b"</release>")
+        if close != -1:
+            segment = segment[:close + len(b"</release>")]
+        yield start, segment
+
+
+def parse_release_alone(segment):
+    # Tek bir kaydı yeniden ayrıştırın; recover moduna yalnızca bu kayıt için geçin
     try:
-        parser = etree.XMLParser(recover=True)  # Hata bulunan XML dosyalarını işlemek için recover=True kullanın
-        tree = etree.parse(dosya_yolu, parser=parser)
-        root = tree.getroot()
+        return etree.fromstring(segment, parser=etree.XMLParser(recover=False)), None
+    except etree.XMLSyntaxError as e:
+        release = etree.fromstring(segment, parser=etree.XMLParser(recover=True))
+        if release is None or release.tag != "release" or release.get("id") is None:
+            release = None
+        return release, e
+
+
+def quarantine_record(source_name, offset, segment, error, action):
+    match = release_id_pattern.search(segment)
+    return {
+        "source": source_name, "offset": offset,
+        "release_id": match.group(1).decode() if match else None,
+        "error": str(error), "action": action,
+        "xml": segment.decode("utf-8", errors="replace")
+    }
 
-        rows = []  # Her dosyadan gelen satırları saklamak için bir liste oluşturun
 
+def parse_xml_data(data, source_name="", base_offset=0):
+    # data bir veya daha fazla <release> öğesi içerir; tüm bir parça dosyası ya da dökümün bir bayt aralığı olabilir.
+    # Ayrıştırılan satırları ve temiz ayrıştırılamayıp karantinaya alınan kayıtları döndürür.
+    rows = []  # Her dosyadan gelen satırları saklamak için bir liste oluşturun
+    quarantined = []
+
+    wrapped = data
+    if not data.lstrip().startswith(b"<root>"):
+        wrapped = b"<root>\n" + data + b"</root>\n"
+    try:
+        # Hızlı yol: tüm parçanın katı ayrıştırılması
+        root = etree.fromstring(wrapped, parser=etree.XMLParser(recover=False))
         for release in root.xpath(".//release"):
-            release_id = release.get("id")
-            status = release.get("status")
-            title = release.findtext("title") or ""
-            artist_id = release.findtext(".//artist/id") or ""
-            artist_name = release.findtext(".//artist/name") or ""
-            label_elem = release.find(".//labels/label")
-            if label_elem is not None:
-                label_name = label_elem.get("name")
-                label_id = label_elem.get("id")
-            else:
-                label_name = ""
-                label_id = ""
-
-            format_elem = release.find(".//formats/format")
-            if format_elem is not None:
-                format = format_elem.get("name")
-            else:
-                format = ""
-
-            genre = release.findtext(".//genres/genre") or ""
-            style = release.findtext(".//styles/style") or ""
-            country = release.findtext("country") or ""
-            release_date = release.findtext("released") or ""
-            notes = release.findtext("notes") or ""
-            master_id_elem = release.find(".//master_id[@is_main_release='true']")
-            if master_id_elem is not None:
-                master_id = master_id_elem.text
-            else:
-                master_id = ""
-
-            video_elem = release.find(".//videos/video")
-            if video_elem is not None:
-                video_url = video_elem.get("src")
-            else:
-                video_url = ""
-
-            company_name_elem = release.find(".//companies/company/name")
-            if company_name_elem is not None:
-                company_name = company_name_elem.text
-            else:
-                company_name = ""
-
-            # Her satırı bir sözlük olarak saklayın
-            row = {
-                "release_id": release_id, "status": status, "title": title, "artist_id": artist_id,
-                "artist_name": artist_name, "label_name": label_name, "label_id": label_id,
-                "format": format, "genre": genre, "style": style, "country": country,
-                "release_date": release_date, "notes": notes, "master_id": master_id,
-                "video_url": video_url, "company_name": company_name
-            }
-            rows.append(row)
+            try:
+                rows.append(parse_release(release))
+            except Exception as e:
+                segment = etree.tostring(release)
+                # Katı ayrıştırma bayt konumlarını tutmaz, bu yüzden kaydı id'siyle data içinde arayın
+                offset = data.find(b'<release id="%s"' % release.get("id", "").encode())
+                offset = base_offset + offset if offset != -1 else None
+                quarantined.append(quarantine_record(source_name, offset, segment, e, "dropped"))
+        return rows, quarantined
+    except etree.XMLSyntaxError:
+        pass
+
+    # Yavaş yol: yalnızca hatalı kayıtlar recover modunda yeniden ayrıştırılır, parçanın geri kalanı devam eder
+    for offset, segment in split_releases(data):
+        offset += base_offset
+        try:
+            release, error = parse_release_alone(segment)
+            if release is None:
+                quarantined.append(quarantine_record(source_name, offset, segment, error, "dropped"))
+                continue
+            rows.append(parse_release(release))
+            if error is not None:
+                quarantined.append(quarantine_record(source_name, offset, segment, error, "recovered"))
+        except Exception as e:
+            quarantined.append(quarantine_record(source_name, offset, segment, e, "dropped"))
+
+    return rows, quarantined
+
+
+def write_quarantine(quarantined, output_path):
+    # Her hatalı kayıt için, düzeltip tek başına yeniden çalıştırmaya yetecek bilgiyle bir JSON satırı
+    if not quarantined:
+        # Temiz bir çalıştırma, önceki bir çalıştırmadan kalan karantina dosyasını siler
+        try:
+            os.remove(output_path)
+        except FileNotFoundError:
+            pass
+        return
+    with open(output_path, "w", encoding="utf-8") as quarantine_file:
+        for record in quarantined:
+            quarantine_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
 
+def write_rows_csv(rows, output_path):
+    # Sabit şema, boş çıktıların ve sütun sırasının dosyalar arasında tutarlı kalmasını sağlar
+    df = pl.DataFrame(rows, schema={column: pl.String for column in columns})
+    df.write_csv(output_path)
+
+
+def process_xml_file(dosya_adi):
+    dosya_yolu = os.path.join(klasor_yolu, dosya_adi)
+    try:
+        with open(dosya_yolu, "rb") as xml_file:
+            rows, quarantined = parse_xml_data(xml_file.read(), dosya_adi)
+        os.makedirs(quarantine_folder, exist_ok=True)
+        write_quarantine(quarantined, os.path.join(quarantine_folder, f"{dosya_adi[:-4]}.jsonl"))
+        if quarantined:
+            print(f"{dosya_adi}: {len(quarantined)} hatalı kayıt {quarantine_folder} klasörüne yazıldı")
         return rows
     except Exception as e:
         print(f'Hata: {dosya_adi} işlenirken bir hata oluştu: {str(e)}')
@@ -77,56 +203,69 @@ def print_processed_count(processed_count):
     print(f"{processed_count} dosya işlendi...")
 
 
-# İşlem yapmak istediğiniz klasörün yolu
-klasor_yolu = 'chunked'
+def main():
+    # Klasördeki XML dosyalarını listeleyin
+    dosya_listesi = [dosya for dosya in os.listdir(klasor_yolu) if dosya.endswith('.xml')]
+
+    # Dosya sayacı
+    dosya_sayaci = 0
+
+    # İşlem süre sayaçları
+    toplam_islem_suresi = 0
 
-# Klasördeki XML dosyalarını listeleyin
-dosya_listesi = [dosya for dosya in os.listdir(klasor_yolu) if dosya.endswith('.xml')]
+    # Verileri saklamak için bir liste oluşturun
+    data_list = []
 
-# Dosya sayacı
-dosya_sayaci = 0
+    # Parçalar tamamlandıkça arama dizinini ve özet tabloları besleyin, böylece CSV üzerinden ikinci bir geçiş gerekmez
+    index_builder = SearchIndexBuilder(search_index_folder) if search_index_folder else None
+    accumulator = AggregateAccumulator() if report_folder else None
 
-# İşlem süre sayaçları
-toplam_islem_suresi = 0
+    # Paralel işlem için ThreadPoolExecutor kullanın
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = []
 
-# Verileri saklamak için bir liste oluşturun
-data_list = []
+        for dosya_adi in dosya_listesi:
+            dosya_sayaci += 1
+            print(f"{dosya_sayaci}. dosya işleniyor...")
 
-# Paralel işlem için ThreadPoolExecutor kullanın
-with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-    futures = []
+            baslangic_zamani = time.time()  # İşlem süresi başlangıcı
 
-    for dosya_adi in dosya_listesi:
-        dosya_sayaci += 1
-        print(f"{dosya_sayaci}. dosya işleniyor...")
+            # İşlemi paralel olarak başlatın
+            future = executor.submit(process_xml_file, dosya_adi)
+            futures.append(future)
 
-        baslangic_zamani = time.time()  # İşlem süresi başlangıcı
+        processed_count = 0  # İşlenen dosya sayısını takip etmek için sayaç
 
-        # İşlemi paralel olarak başlatın
-        future = executor.submit(process_xml_file, dosya_adi)
-        futures.append(future)
+        # İşlem tamamlandığında işlenen dosya sayısını hızlıca takip etmek için kullanılacak bir set oluşturun
+        processed_set = set()
 
-    processed_count = 0  # İşlenen dosya sayısını takip etmek için sayaç
+        for future in concurrent.futures.as_completed(futures):
+            rows = future.result()
+            if rows is not None:
+                # Liste içindeki her satırı data_list'e ekleyin
+                data_list.extend(rows)
+                if index_builder is not None:
+                    index_builder.add_rows(rows)
+                if accumulator is not None:
+                    accumulator.add_rows(rows)
+                processed_count += 1
+                processed_set.add(processed_count)  # İşlenen dosya sayısını ekleyin
+                print_processed_count(processed_count)  # İşlenen dosya sayısını ekrana yazdırın
 
-    # İşlem tamamlandığında işlenen dosya sayısını hızlıca takip etmek için kullanılacak bir set oluşturun
-    processed_set = set()
+    # data_list'i bir Polars DataFrame'e dönüştürün ve bir CSV dosyasına kaydedin
+    write_rows_csv(data_list, 'discogs.csv')
 
-    for future in concurrent.futures.as_completed(futures):
-        rows = future.result()
-        if rows is not None:
-            # Liste içindeki her satırı data_list'e ekleyin
-            data_list.extend(rows)
-            processed_count += 1
-            processed_set.add(processed_count)  # İşlenen dosya sayısını ekleyin
-            print_processed_count(processed_count)  # İşlenen dosya sayısını ekrana yazdırın
+    if index_builder is not None:
+        term_count = index_builder.finish()
+        print(f"{term_count} terimli arama dizini {search_index_folder} klasöründe oluşturuldu")
 
-# data_list'i bir Polars DataFrame'e dönüştürün
-df = pl.DataFrame(data_list)
+    if accumulator is not None:
+        write_report(accumulator.summaries(), report_folder, report_format)
 
-# Polars DataFrame'i bir CSV dosyasına kaydedin
-df.write_csv('discogs.csv')
+    # İşlem süresini ve dosya sayısını yazdırın
+    print(f"Toplam {dosya_sayaci} XML dosyası işlendi.")
+    print(f"Toplam işlem süresi: {toplam_islem_suresi:.2f} saniye")
 
-# İşlem süresini ve dosya sayısını yazdırın
-print(f"Toplam {dosya_sayaci} XML dosyası işlendi.")
-print(f"Toplam işlem süresi: {toplam_islem_suresi:.2f} saniye")
 
+if __name__ == "__main__":
+    main()
@@ -2,78 +2,27 @@ import os
 import time
 import concurrent.futures
 import psycopg2
-from lxml import etree
+
+from discogs_xml2csv_eng import parse_xml_data, quarantine_folder, write_quarantine
 
 
 def process_xml_file(file_name, db_connection, processed_count, start_time):
     file_path = os.path.join(folder_path, file_name)
     try:
-        parser = etree.XMLParser(recover=True)  # Use recover=True to process XML files with errors
-        tree = etree.parse(file_path, parser=parser)
-        root = tree.getroot()
-
-        rows = []  # Create a list to store rows from each file
-
-        for release in root.xpath(".//release"):
-            release_id = release.get("id")
-            status = release.get("status")
-            title = release.findtext("title") or ""
-            artist_id = release.findtext(".//artist/id") or ""
-            artist_name = release.findtext(".//artist/name") or ""
-            label_elem = release.find(".//labels/label")
-            if label_elem is not None:
-                label_name = label_elem.get("name")
-                label_id = label_elem.get("id")
-            else:
-                label_name = ""
-                label_id = ""
-
-            format_elem = release.find(".//formats/format")
-            if format_elem is not None:
-                format = format_elem.get("name")
-            else:
-                format = ""
-
-            genre = release.findtext(".//genres/genre") or ""
-            style = release.findtext(".//styles/style") or ""
-            country = release.findtext("country") or ""
-            release_date = release.findtext("released") or ""
-            notes = release.findtext("notes") or ""
-
-            master_id_elem = release.find(".//master_id[@is_main_release='true']")
-            if master_id_elem is not None:
-                master_id = master_id_elem.text
-            else:
-                master_id = ""
-
-            video_elem = release.find(".//videos/video")
-            if video_elem is not None:
-                video_url = video_elem.get("src")
-            else:
-                video_url = ""
-
-            company_name_elem = release.find(".//companies/company/name")
-            if company_name_elem is not None:
-                company_name = company_name_elem.text
-            else:
-                company_name = ""
+        with open(file_path, "rb") as xml_file:
+            rows, quarantined = parse_xml_data(xml_file.read(), file_name)
+        os.makedirs(quarantine_folder, exist_ok=True)
+        write_quarantine(quarantined, os.path.join(quarantine_folder, f"{file_name[:-4]}.jsonl"))
+        if quarantined:
+            print(f"{file_name}: {len(quarantined)} malformed releases written to {quarantine_folder}")
 
+        for row in rows:
             # Store dates as years
-            release_date_str = release_date.split('-')[0]
+            release_date_str = row["release_date"].split('-')[0]
             if len(release_date_str) == 4 and release_date_str.isdigit():
-                release_date = int(release_date_str)
+                row["release_date"] = int(release_date_str)
             else:
-                release_date = None
-
-            # Store each row as a dictionary
-            row = {
-                "release_id": release_id, "status": status, "title": title, "artist_id": artist_id,
-                "artist_name": artist_name, "label_name": label_name, "label_id": label_id,
-                "format": format, "genre": genre, "style": style, "country": country,
-                "release_date": release_date, "notes": notes, "master_id": master_id,
-                "video_url": video_url, "company_name": company_name
-            }
-            rows.append(row)
+                row["release_date"] = None
 
         # Add data to the database
         insert_data_to_db(db_connection, rows)
@@ -107,6 +56,41 @@ def insert_data_to_db(db_connection, rows):
         print(f'Error: An error occurred while inserting data into the database: {str(e)}')
 
 
+def create_search_indexes(db_connection):
+    # Built once after the bulk load, so inserts are not slowed down by index maintenance
+    try:
+        cursor = db_connection.cursor()
+        # Full-text search over titles, artists and notes through a generated tsvector column
+        cursor.execute("""
+        ALTER TABLE discogs ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(artist_name, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(notes, '')), 'C')
+        ) STORED
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS discogs_search_vector_idx ON discogs USING GIN (search_vector)")
+        db_connection.commit()
+        cursor.close()
+        print("Full-text search index created.")
+    except Exception as e:
+        db_connection.rollback()
+        print(f'Error: An error occurred while creating the full-text search index: {str(e)}')
+
+    try:
+        cursor = db_connection.cursor()
+        # Trigram indexes speed up ILIKE '%...%' and similarity searches on titles and artists
+        # Committed separately: roles that may not create extensions still keep the full-text index
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute("CREATE INDEX IF NOT EXISTS discogs_title_trgm_idx ON discogs USING GIN (title gin_trgm_ops)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS discogs_artist_name_trgm_idx ON discogs USING GIN (artist_name gin_trgm_ops)")
+        db_connection.commit()
+        cursor.close()
+        print("Trigram indexes created.")
+    except Exception as e:
+        db_connection.rollback()
+        print(f'Error: An error occurred while creating the trigram indexes: {str(e)}')
+
+
 # Create a PostgreSQL database connection
 db_connection = psycopg2.connect(
     host="localhost",
@@ -178,6 +162,9 @@ with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
         if future.result():
             processed_count += 1
 
+# Create the search indexes now that all rows are loaded
+create_search_indexes(db_connection)
+
 # Close the database connection
 db_connection.close()
 